@@ -1,102 +1,207 @@
 import os
+import hashlib
 import tempfile
+import threading
 import json
+import orjson
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import xarray as xr
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 app = Flask(__name__)
 
-# --- Helper: Convert Argo JULD to datetime --- #
-def julian_to_datetime(juld_days):
-    """Convert Argo 'JULD' (days since 1950-01-01) into ISO datetime string."""
-    if pd.isna(juld_days):
-        return None
-    try:
-        ref_date = datetime(1950, 1, 1)
-        return (ref_date + timedelta(days=float(juld_days))).isoformat()
-    except Exception:
-        return None
+UPLOAD_BUFFER_SIZE = 8 * 1024 * 1024  # bytes per read when spooling uploads to disk
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", 64 * 1024 * 1024))  # per-worker cache budget
+
+# --- Helper: JSON responses encoded by orjson --- #
+JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def json_response(body, status=200):
+    """Return body (an object, or bytes already encoded with JSON_OPTIONS) as a JSON Response."""
+    if not isinstance(body, bytes):
+        body = orjson.dumps(body, option=JSON_OPTIONS)
+    return Response(body, status=status, mimetype="application/json")
+
+# --- Helper: LRU of serialized responses keyed by upload content hash --- #
+_result_cache = OrderedDict()
+_result_cache_bytes = 0
+_result_cache_lock = threading.Lock()
+
+def cached_response(digest):
+    with _result_cache_lock:
+        payload = _result_cache.get(digest)
+        if payload is not None:
+            _result_cache.move_to_end(digest)
+        return payload
+
+def cache_response(digest, payload):
+    global _result_cache_bytes
+    if len(payload) > RESULT_CACHE_BYTES:
+        return
+    with _result_cache_lock:
+        previous = _result_cache.pop(digest, None)
+        if previous is not None:
+            _result_cache_bytes -= len(previous)
+        _result_cache[digest] = payload
+        _result_cache_bytes += len(payload)
+        while _result_cache_bytes > RESULT_CACHE_BYTES:
+            _, evicted = _result_cache.popitem(last=False)
+            _result_cache_bytes -= len(evicted)
+
+# --- Helper: Spool an upload to disk while hashing it --- #
+def spool_upload(stream, dest):
+    """Copy an upload stream into dest in large blocks and return its BLAKE2b digest."""
+    digest = hashlib.blake2b()
+    while True:
+        chunk = stream.read(UPLOAD_BUFFER_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        dest.write(chunk)
+    return digest.hexdigest()
 
-# --- Helper: Replace NaNs in lists with None --- #
-def clean_list(arr):
-    return [None if (isinstance(x, float) and np.isnan(x)) else x for x in arr]
+# --- Helper: Convert Argo JULD to datetime --- #
+def julian_to_iso(juld_days):
+    """Convert an array of Argo 'JULD' (days since 1950-01-01) into ISO datetime strings."""
+    dates = pd.to_datetime(pd.Series(juld_days, dtype="float64"), unit="D",
+                           origin=pd.Timestamp("1950-01-01"), errors="coerce")
+    iso = dates.dt.strftime("%Y-%m-%dT%H:%M:%S")
+    return iso.astype(object).where(dates.notna(), None).tolist()
+
+# --- Helper: Decode Argo char arrays into strings --- #
+def decode_strings(values):
+    """Decode fixed-width byte strings (or a 2D char array) into stripped str values, "" where missing."""
+    values = np.asarray(values)
+    if values.dtype == object:
+        # Char variables with a _FillValue decode to bytes objects with NaN in the filled slots
+        values = np.where(pd.isna(values), b"", values).astype("S")
+    if values.dtype.kind == "S":
+        if values.ndim > 1 and values.dtype.itemsize == 1:
+            values = np.ascontiguousarray(values).view(f"S{values.shape[-1]}")[..., 0]
+        values = np.char.decode(values, "utf-8")
+    return np.char.strip(values.astype(str))
+
+# --- Helper: Per-profile NaN-ignoring means (Numba when available) --- #
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True)
+    def _row_nanmean(row):
+        total, count = 0.0, 0
+        for value in row:
+            if not np.isnan(value):
+                total += value
+                count += 1
+        return total / count if count > 0 else np.nan
+
+    @njit(parallel=True, cache=True)
+    def profile_means(pres, temp, psal):
+        """Mean of each profile row for all three grids in one parallel sweep."""
+        n_prof = pres.shape[0]
+        means = np.empty((3, n_prof), dtype=np.float64)
+        for i in prange(n_prof):
+            means[0, i] = _row_nanmean(pres[i])
+            means[1, i] = _row_nanmean(temp[i])
+            means[2, i] = _row_nanmean(psal[i])
+        return means[0], means[1], means[2]
+else:
+    def _nanmean_rows(grid):
+        # Accumulate in float64 like the Numba kernel so both paths serve identical means
+        with np.errstate(invalid="ignore", divide="ignore"):  # all-NaN profiles -> NaN
+            return np.nansum(grid, axis=1, dtype=np.float64) / np.count_nonzero(~np.isnan(grid), axis=1)
+
+    def profile_means(pres, temp, psal):
+        """Mean of each profile row for all three grids."""
+        return _nanmean_rows(pres), _nanmean_rows(temp), _nanmean_rows(psal)
+
+# --- Helper: Columnar (struct-of-arrays) table layout --- #
+def columnar(data):
+    """Wrap a {column: values} mapping as {"columns": [...], "data": {...}}."""
+    return {"columns": list(data), "data": data}
 
 # --- Parser Function --- #
 def parse_argo_file(file_path):
     try:
-        with xr.open_dataset(file_path, decode_times=False) as ds:
+        # Each variable is read exactly once, so skip xarray's in-memory array cache
+        with xr.open_dataset(file_path, engine="netcdf4", decode_times=False, cache=False) as ds:
             # Decode platform numbers
-            platform_ids = [
-                bytes(p).decode("utf-8").strip() if isinstance(p, (bytes, np.bytes_)) else str(p).strip()
-                for p in ds["PLATFORM_NUMBER"].values
+            platform_ids = decode_strings(ds["PLATFORM_NUMBER"].values)
+
+            # Adjusted vs raw data, read in one pass with profiles on the first axis
+            available = [
+                v for v in ["PRES", "TEMP", "PSAL", "PRES_ADJUSTED", "TEMP_ADJUSTED", "PSAL_ADJUSTED"]
+                if v in ds
             ]
-            n_prof = len(platform_ids)
-
-            # Adjusted vs raw data
-            pres_adj = ds["PRES_ADJUSTED"].values if "PRES_ADJUSTED" in ds else None
-            temp_adj = ds["TEMP_ADJUSTED"].values if "TEMP_ADJUSTED" in ds else None
-            psal_adj = ds["PSAL_ADJUSTED"].values if "PSAL_ADJUSTED" in ds else None
-
-            pres_raw = ds["PRES"].values
-            temp_raw = ds["TEMP"].values
-            psal_raw = ds["PSAL"].values
-
-            data_modes = ds["DATA_MODE"].values
-
-            # Ensure dimensions consistent
-            if pres_raw.shape[0] != n_prof:
-                pres_raw, temp_raw, psal_raw = pres_raw.T, temp_raw.T, psal_raw.T
-                if pres_adj is not None: pres_adj = pres_adj.T
-                if temp_adj is not None: temp_adj = temp_adj.T
-                if psal_adj is not None: psal_adj = psal_adj.T
-
-            cycle_data, full_arrays = [], []
-            for i in range(n_prof):
-                profile_id = f"{platform_ids[i]}_{int(ds['CYCLE_NUMBER'].values[i])}"
-                current_data_mode = bytes(data_modes[i]).decode("utf-8").strip()
-
-                # Select adjusted data if available, otherwise raw
-                if current_data_mode in ['D', 'A'] and pres_adj is not None:
-                    pres_profile = pres_adj[i]
-                    temp_profile = temp_adj[i]
-                    psal_profile = psal_adj[i]
-                else:
-                    pres_profile = pres_raw[i]
-                    temp_profile = temp_raw[i]
-                    psal_profile = psal_raw[i]
-
-                # Convert to lists
-                pres_list = pres_profile.tolist()
-                temp_list = temp_profile.tolist()
-                psal_list = psal_profile.tolist()
-
-                # Append cleaned cycle data
-                cycle_data.append({
-                    "profile_id": profile_id,
-                    "wmo_float_id": platform_ids[i],
-                    "cycle_id": int(ds["CYCLE_NUMBER"].values[i]),
-                    "date_time_utc": julian_to_datetime(ds["JULD"].values[i]),
-                    "latitude": float(ds["LATITUDE"].values[i]),
-                    "longitude": float(ds["LONGITUDE"].values[i]),
-                    "data_mode": current_data_mode,
-                    "pres_mean_dbar": float(np.nanmean(pres_profile)) if not np.isnan(np.nanmean(pres_profile)) else None,
-                    "temp_mean_degc": float(np.nanmean(temp_profile)) if not np.isnan(np.nanmean(temp_profile)) else None,
-                    "psal_mean_psu": float(np.nanmean(psal_profile)) if not np.isnan(np.nanmean(psal_profile)) else None,
-                })
-
-                # Append full arrays cleaned of NaNs
-                full_arrays.append({
-                    "profile_id": profile_id,
-                    "temp_array": clean_list(temp_list),
-                    "psal_array": clean_list(psal_list),
-                    "pres_array": clean_list(pres_list)
-                })
+            grids = {v: ds[v].transpose("N_PROF", ...).values.astype(np.float32, copy=False) for v in available}
+
+            pres_adj = grids.get("PRES_ADJUSTED")
+            temp_adj = grids.get("TEMP_ADJUSTED")
+            psal_adj = grids.get("PSAL_ADJUSTED")
+
+            pres_raw = grids["PRES"]
+            temp_raw = grids["TEMP"]
+            psal_raw = grids["PSAL"]
+
+            data_modes = decode_strings(ds["DATA_MODE"].values)
+            dates_iso = julian_to_iso(ds["JULD"].values)
+            lats = ds["LATITUDE"].values.tolist()
+            lons = ds["LONGITUDE"].values.tolist()
+
+            # Per-profile id columns, assembled positionally in one pass.
+            # Missing cycle numbers (_FillValue -> NaN) become null ids without a suffix.
+            cycle_numbers = ds["CYCLE_NUMBER"].values
+            has_cycle = ~np.isnan(cycle_numbers)
+            cycle_ids = np.where(has_cycle, cycle_numbers, 0).astype("int64")
+            profile_ids = np.where(
+                has_cycle, np.char.add(np.char.add(platform_ids, "_"), cycle_ids.astype(str)), platform_ids
+            ).tolist()
+            cycle_ids = np.where(has_cycle, cycle_ids, None).tolist()
+
+            # Select adjusted data if available, otherwise raw
+            if pres_adj is not None and temp_adj is not None and psal_adj is not None:
+                use_adj = np.isin(data_modes, ['D', 'A'])[:, None]
+                pres_sel = np.where(use_adj, pres_adj, pres_raw)
+                temp_sel = np.where(use_adj, temp_adj, temp_raw)
+                psal_sel = np.where(use_adj, psal_adj, psal_raw)
+            else:
+                pres_sel, temp_sel, psal_sel = pres_raw, temp_raw, psal_raw
+
+            # Keep profiles as contiguous buffers; orjson writes them (NaN -> null) directly
+            pres_sel, temp_sel, psal_sel = (
+                np.ascontiguousarray(g) for g in (pres_sel, temp_sel, psal_sel)
+            )
+
+            pres_means, temp_means, psal_means = profile_means(pres_sel, temp_sel, psal_sel)
+
+            # Cycle data as one column per field, N_PROF values each (NaNs serialize as null)
+            cycle_data = columnar({
+                "profile_id": profile_ids,
+                "wmo_float_id": platform_ids.tolist(),
+                "cycle_id": cycle_ids,
+                "date_time_utc": dates_iso,
+                "latitude": lats,
+                "longitude": lons,
+                "data_mode": data_modes.tolist(),
+                "pres_mean_dbar": pres_means,
+                "temp_mean_degc": temp_means,
+                "psal_mean_psu": psal_means,
+            })
+
+            # Full arrays as one column per variable, (N_PROF, N_LEVELS) each
+            full_arrays = columnar({
+                "profile_id": profile_ids,
+                "temp_array": temp_sel,
+                "psal_array": psal_sel,
+                "pres_array": pres_sel,
+            })
 
             return {"cycle_data": cycle_data, "full_arrays": full_arrays}
 
@@ -108,19 +213,31 @@ def parse_argo_file(file_path):
 @app.route("/upload", methods=["POST"])
 def upload_file():
     if "file" not in request.files:
-        return jsonify({"error": "No file provided"}), 400
+        return json_response({"error": "No file provided"}, 400)
 
     file = request.files["file"]
     if file.filename == "":
-        return jsonify({"error": "Empty filename"}), 400
+        return json_response({"error": "Empty filename"}, 400)
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".nc") as tmp_file:
-        file.save(tmp_file.name)
-        logging.info(f"Processing temporary file: {tmp_file.name}")
-        result = parse_argo_file(tmp_file.name)
+    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".nc")
+    try:
+        # Stream the upload to disk in large blocks, closing it before xarray opens it
+        with tmp_file:
+            digest = spool_upload(file.stream, tmp_file)
+
+        payload = cached_response(digest)
+        if payload is not None:
+            logging.info(f"Serving cached result for upload {digest[:16]}")
+        else:
+            logging.info(f"Processing temporary file: {tmp_file.name}")
+            result = parse_argo_file(tmp_file.name)
+            payload = orjson.dumps(result, option=JSON_OPTIONS)
+            if "error" not in result:
+                cache_response(digest, payload)
+    finally:
         os.unlink(tmp_file.name)
 
-    return jsonify(result)
+    return json_response(payload)
 
 # --- Run --- #
 if __name__ == "__main__":